@@ -0,0 +1,21 @@
+"""gunicorn 配置: gunicorn -c gunicorn.conf.py promptoon:app
+
+端口、进程数与每进程线程数可通过 PORT / WORKERS / THREADS 环境变量覆盖
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WORKERS", "2"))
+
+# 上游 Gemini/豆包请求耗时较长，使用线程 worker 让单个进程同时处理多个请求
+# 图片压缩在请求线程中执行，不会像协程 worker 那样阻塞同进程的其他请求
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", "16"))
+
+# 需大于上游请求超时(60s)与图片处理耗时之和
+timeout = 90
+
+# 不预加载应用: 每个 worker 在 fork 之后各自导入 promptoon，
+# 日志 QueueListener、IO 线程池与 HTTP 连接池均在子进程内创建，不会跨进程共享
+preload_app = False
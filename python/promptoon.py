@@ -1,22 +1,72 @@
+import argparse
+import atexit
 import base64
+import binascii
+import hashlib
 import io
-import json
 import logging
+import mmap
 import os
-import uuid
+import queue
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from logging.handlers import TimedRotatingFileHandler
+from functools import lru_cache
+from logging.handlers import (
+    MemoryHandler,
+    QueueHandler,
+    QueueListener,
+    TimedRotatingFileHandler,
+)
+from operator import itemgetter
+from types import MappingProxyType
 
-import requests
+import httpx
+import orjson
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from flask import Flask, jsonify, render_template, request
 from flask_cors import CORS
 from PIL import Image
 from volcenginesdkarkruntime import Ark
+from werkzeug.exceptions import RequestEntityTooLarge
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # 未安装 libvips 时退回 Pillow
+    pyvips = None
+
+try:
+    from pybase64 import b64encode as _b64encode
+except ImportError:
+    # 未安装 pybase64 时退回标准库实现
+    def _b64encode(data):
+        return binascii.b2a_base64(data, newline=False)
+
+
+# 本进程已确认存在的目录，避免重复 stat
+_KNOWN_DIRS = set()
+
+
+def ensure_dir(path):
+    """确保目录存在，同一目录只在首次调用时访问文件系统"""
+    if path not in _KNOWN_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _KNOWN_DIRS.add(path)
+
 
 # 日志目录
 LOG_DIR = "./logs"
-os.makedirs(LOG_DIR, exist_ok=True)
+ensure_dir(LOG_DIR)
 
 # 创建日志器
 logger = logging.getLogger(__name__)
@@ -28,7 +78,6 @@ formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 # 控制台 Handler
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
 
 # 每日轮转文件 Handler
 file_handler = TimedRotatingFileHandler(
@@ -39,28 +88,212 @@ file_handler = TimedRotatingFileHandler(
     delay=True,
 )
 file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+
+# 缓冲文件日志，INFO 记录攒满一批再落盘，WARNING 及以上立即刷新
+mem_handler = MemoryHandler(
+    capacity=64,
+    flushLevel=logging.WARNING,
+    target=file_handler,
+    flushOnClose=True,
+)
+atexit.register(mem_handler.flush)
+
+# 消息与异常堆栈仍由 QueueHandler.prepare 在请求线程中格式化，Handler 加锁与写入在后台监听线程中完成
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(
+    log_queue, console_handler, mem_handler, respect_handler_level=True
+)
+log_listener.start()
+
+
+def _stop_log_listener():
+    """停止日志监听线程并处理完队列中剩余的记录，已停止时直接返回"""
+    # Python 3.12 之前 QueueListener.stop 不能重复调用
+    if log_listener._thread is not None:
+        log_listener.stop()
+
+
+atexit.register(_stop_log_listener)
+
+LOG_FLUSH_INTERVAL = 30
+
+
+def _flush_logs_periodically():
+    """定时刷新日志缓冲，避免 INFO 记录长时间滞留在内存中"""
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        mem_handler.flush()
+
+
+threading.Thread(target=_flush_logs_periodically, name="log-flush", daemon=True).start()
+
+
+def _install_sigterm_flush():
+    """收到 SIGTERM 时先刷新日志缓冲，再交给原有的处理逻辑"""
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handler(signum, frame):
+        if not callable(previous) and previous != signal.SIG_IGN:
+            # 默认处理会直接结束进程，atexit 不会执行，先把队列中的记录交给缓冲
+            _stop_log_listener()
+        mem_handler.flush()
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    try:
+        signal.signal(signal.SIGTERM, handler)
+    except ValueError:
+        # 非主线程中导入时无法注册信号处理
+        pass
+
+
+_install_sigterm_flush()
 app = Flask(__name__)
 CORS(app)
 
+# 请求体大小上限，超出时 werkzeug 在解析表单前直接拒绝
+MAX_REQUEST_SIZE = 20 * 1024 * 1024
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_SIZE
+
 
 ENCRYPTION_KEY = b"zDqHdcnVYuuo6RLCfm7LZ-RQHBPHtW3P9B9JII4GjwM="
+# 仅用于解密旧版 Fernet 密文
 cipher_suite = Fernet(ENCRYPTION_KEY)
+# AES-GCM 密钥由同一主密钥经 HKDF 派生，不与 Fernet 共用密钥材料
+_AEAD = AESGCM(
+    HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"promptoon api key"
+    ).derive(base64.urlsafe_b64decode(ENCRYPTION_KEY))
+)
+# 密文格式: 版本字节 + 12 字节 nonce + 密文及 tag
+_TOKEN_VERSION = b"\x01"
+_FERNET_VERSION = 0x80
+_NONCE_SIZE = 12
 
 
 def encrypt_api_key(api_key):
     """加密API Key"""
-    return cipher_suite.encrypt(api_key.encode()).decode()
+    nonce = os.urandom(_NONCE_SIZE)
+    ciphertext = _AEAD.encrypt(nonce, api_key.encode(), _TOKEN_VERSION)
+    return base64.urlsafe_b64encode(_TOKEN_VERSION + nonce + ciphertext).decode()
 
 
+@lru_cache(maxsize=256)
 def decrypt_api_key(encrypted_api_key):
-    """解密API Key"""
-    return cipher_suite.decrypt(encrypted_api_key.encode()).decode()
+    """解密API Key
+    同一密文的解密结果固定不变，缓存后重复提交无需再做认证与解密
+    """
+    token = base64.urlsafe_b64decode(encrypted_api_key)
+    if token[:1] == _TOKEN_VERSION:
+        nonce = token[1 : 1 + _NONCE_SIZE]
+        ciphertext = token[1 + _NONCE_SIZE :]
+        return _AEAD.decrypt(nonce, ciphertext, _TOKEN_VERSION).decode()
+    if token[:1] == bytes((_FERNET_VERSION,)):
+        # 浏览器本地保存的旧密文仍按 Fernet 解密
+        return cipher_suite.decrypt(encrypted_api_key.encode()).decode()
+    raise ValueError("未知的 API Key 密文格式")
 
 
 UPLOAD_BASE_DIR = "./uploads"
 CONFIG_DIR = "./prompts"
 
+# 当日上传目录缓存: (次日零点时间戳, 当日上传目录)
+_DAY_CACHE = (0.0, "")
+_DAY_LOCK = threading.Lock()
+
+
+def today_upload_dir():
+    """当日上传目录，只在跨天后重新格式化日期并创建目录"""
+    global _DAY_CACHE
+    # 一次读取整个元组，保证时间戳与目录来自同一次刷新
+    expires_at, save_dir = _DAY_CACHE
+    if time.time() < expires_at:
+        return save_dir
+    with _DAY_LOCK:
+        # 等锁期间可能已被其他线程刷新
+        if time.time() >= _DAY_CACHE[0]:
+            now = time.localtime()
+            next_midnight = time.mktime(
+                (now.tm_year, now.tm_mon, now.tm_mday + 1, 0, 0, 0, 0, 0, -1)
+            )
+            save_dir = os.path.join(UPLOAD_BASE_DIR, time.strftime("%Y-%m-%d", now))
+            ensure_dir(save_dir)
+            _DAY_CACHE = (next_midnight, save_dir)
+        return _DAY_CACHE[1]
+
+
+# 代理配置（未设置的项不传入，避免空字符串被当作代理地址）
+PROXIES = {
+    scheme: proxy
+    for scheme, proxy in (
+        ("http", os.environ.get("HTTP_PROXY", "")),
+        ("https", os.environ.get("HTTPS_PROXY", "")),
+    )
+    if proxy
+}
+
+
+def _http_transport(proxy):
+    return httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        proxy=proxy,
+    )
+
+
+# 全局复用的 HTTP/2 客户端，并发请求共用同一条到 Gemini 的 TLS 连接
+HTTP_CLIENT = httpx.Client(
+    mounts={
+        "http://": _http_transport(PROXIES.get("http")),
+        "https://": _http_transport(PROXIES.get("https")),
+    },
+    headers={"Content-Type": "application/json"},
+    timeout=60,
+    trust_env=False,
+)
+
+# 豆包 Ark 客户端共用的连接池
+ARK_HTTP_CLIENT = httpx.Client(
+    mounts={
+        "http://": _http_transport(PROXIES.get("http")),
+        "https://": _http_transport(PROXIES.get("https")),
+    },
+    trust_env=False,
+)
+
+
+# Ark SDK 的客户端不保证线程安全，按线程各自缓存，底层仍共用同一个连接池
+_ARK_CLIENTS = threading.local()
+ARK_CLIENT_CACHE_SIZE = 32
+
+
+def _ark_client(api_key):
+    """按 API Key 缓存当前线程的 Ark 客户端，重复请求复用已建立的连接"""
+    clients = getattr(_ARK_CLIENTS, "clients", None)
+    if clients is None:
+        clients = _ARK_CLIENTS.clients = {}
+    client = clients.get(api_key)
+    if client is None:
+        if len(clients) >= ARK_CLIENT_CACHE_SIZE:
+            # 超出上限时淘汰最早创建的客户端
+            del clients[next(iter(clients))]
+        client = clients[api_key] = Ark(
+            base_url="https://ark.cn-beijing.volces.com/api/v3",
+            api_key=api_key,
+            http_client=ARK_HTTP_CLIENT,
+        )
+    return client
+
+
+# 后台磁盘写入线程池，详情文件落盘不占用请求线程
+_IO_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="io")
+atexit.register(_IO_POOL.shutdown, wait=True)
+
 
 def load_prompt(prompt_type=0):
     """从本地文件加载提示词配置
@@ -94,50 +327,223 @@ def load_prompt(prompt_type=0):
 
 
 def load_imitation_dialogs():
-    """从本地文件加载示例对话配置"""
+    """从本地文件加载示例对话配置, 以元组返回避免被意外修改"""
     try:
-        with open(
-            os.path.join(CONFIG_DIR, "default_dialogs.json"), "r", encoding="utf-8"
-        ) as f:
-            dialogs = json.load(f)
+        with open(os.path.join(CONFIG_DIR, "default_dialogs.json"), "rb") as f:
+            dialogs = tuple(orjson.loads(f.read()))
         logger.info("✅ 成功加载示例对话配置文件")
         return dialogs
-    except (FileNotFoundError, json.JSONDecodeError) as e:
+    except (FileNotFoundError, orjson.JSONDecodeError) as e:
         logger.error(f"❌ 示例对话配置文件加载失败: {e}")
-        return [
+        return (
             {"role": "user", "parts": [{"text": "[未配置]"}]},
             {"role": "model", "parts": [{"text": "示例对话未配置"}]},
-        ]
+        )
+
+
+# 对话配置中反复出现的字段名与角色名
+_INTERNED_WORDS = frozenset(("user", "model", "parts", "text", "role"))
+
+
+def _freeze(value):
+    """将对话配置递归转为只读结构, 重复出现的键与角色名驻留为同一字符串对象"""
+    if isinstance(value, dict):
+        return MappingProxyType({sys.intern(k): _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, str) and value in _INTERNED_WORDS:
+        return sys.intern(value)
+    return value
 
 
 # 初始化时加载配置
 SYSTEM_PROMPT = load_prompt()
-IMITATION_DIALOGS = load_imitation_dialogs()
+IMITATION_DIALOGS = _freeze(load_imitation_dialogs())
+PROMPTS = {0: SYSTEM_PROMPT, 1: load_prompt(1)}
+
+GEMINI_MODEL_ACK = "我明白了,我会按照您的要求分析图片并生成结构化的提示词..."
+_STATIC_MODEL_ACK = _freeze({"role": "model", "parts": [{"text": GEMINI_MODEL_ACK}]})
+GEMINI_GENERATION_CONFIG = {"maxOutputTokens": 2048, "temperature": 0.7}
+
+# 每种提示词对应的固定对话前缀，预先序列化为 JSON 字节，请求时只需拼接本次的图片
+_PAYLOAD_PREFIX = {
+    prompt_type: b'{"contents":'
+    + orjson.dumps(
+        [
+            {"role": "user", "parts": [{"text": prompt}]},
+            _STATIC_MODEL_ACK,
+            *IMITATION_DIALOGS,
+        ],
+        # MappingProxyType 需转回 dict 才能序列化
+        default=dict,
+    )[:-1]
+    + b","
+    for prompt_type, prompt in PROMPTS.items()
+}
+_PAYLOAD_SUFFIX = (
+    b'],"generationConfig":' + orjson.dumps(GEMINI_GENERATION_CONFIG) + b"}"
+)
 
 
-def compress_image(image_data, max_size_mb=1):
+def _prompt_key(prompt_type):
+    """prompt_type 含义同 load_prompt, 非 1 的取值均按 short 版本处理"""
+    return 1 if prompt_type == 1 else 0
+
+
+def get_prompt(prompt_type=0):
+    """获取已加载的提示词"""
+    return PROMPTS[_prompt_key(prompt_type)]
+
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+# 实际解码像素上限（JPEG 按 DCT 域缩小后计算），超过时视为解压炸弹直接拒绝
+MAX_DECODE_PIXELS = 40_000_000
+JPEGTRAN = shutil.which("jpegtran")
+# 霍夫曼优化通常只能缩小约 10%，超出目标更多时无损优化不可能达标
+JPEGTRAN_MAX_RATIO = 1.15
+# 超大 JPEG 在解码阶段按 1/2、1/4、1/8 缩小，缩小后两边不小于该值
+DECODE_TARGET_EDGE = 2048
+
+
+def _jpeg_shrink_factor(width, height):
+    """JPEG 解码时的缩小倍数，规则与 PIL Image.draft 一致"""
+    scale = min(width // DECODE_TARGET_EDGE, height // DECODE_TARGET_EDGE)
+    for factor in (8, 4, 2):
+        if scale >= factor:
+            return factor
+    return 1
+
+
+def _check_pixels(image_data):
+    """解码前按图片头检查分辨率，返回声明的像素数
+    声明尺寸超出 Pillow 默认阈值时由 Image.open 直接抛出 DecompressionBombError
+    """
+    with Image.open(io.BytesIO(image_data)) as img:
+        width, height = img.size
+    shrink = (
+        _jpeg_shrink_factor(width, height) if image_data.startswith(JPEG_MAGIC) else 1
+    )
+    decode_pixels = (width // shrink) * (height // shrink)
+    if decode_pixels > MAX_DECODE_PIXELS:
+        raise Image.DecompressionBombError(
+            f"图片解码像素数 {decode_pixels} 超过上限 {MAX_DECODE_PIXELS}"
+        )
+    return width * height
+
+
+def _search_jpeg_quality(
+    encode, max_size_bytes, original_size, lo=5, hi=85, max_steps=4
+):
+    """二分查找满足大小限制的最高 JPEG 质量
+    encode(quality, final): 返回编码后的字节, final=False 时跳过耗时的熵编码优化
+    """
+    # 按压缩比例估算首个质量值，多数图片一两次即可落在目标附近
+    quality = min(max(int(hi * max_size_bytes / original_size * 1.3), 25), hi)
+    best_quality = None
+    for _ in range(max_steps):
+        if lo > hi:
+            break
+        if len(encode(quality, False)) <= max_size_bytes:
+            best_quality = quality
+            lo = quality + 1
+        else:
+            hi = quality - 1
+        quality = (lo + hi) // 2
+
+    # 都不满足时退回最低质量，尽量压小
+    return encode(best_quality if best_quality is not None else lo, True)
+
+
+def _vips_jpeg_encoder(image_data):
+    """使用 libvips 解码图片，返回 JPEG 编码函数"""
+    # 顺序读取让解码以流的方式进行，解码结果只在内存中保留一份供多次编码
+    img = pyvips.Image.new_from_buffer(image_data, "", access="sequential")
+    if image_data.startswith(JPEG_MAGIC):
+        shrink = _jpeg_shrink_factor(img.width, img.height)
+        if shrink > 1:
+            img = pyvips.Image.new_from_buffer(
+                image_data, "", access="sequential", shrink=shrink
+            )
+    if img.hasalpha():
+        img = img.flatten(background=[255, 255, 255])
+    if img.interpretation != "srgb":
+        img = img.colourspace("srgb")
+    img = img.copy_memory()
+
+    def encode(quality, final):
+        return img.jpegsave_buffer(
+            Q=quality, optimize_coding=final, strip=True, interlace=False
+        )
+
+    return encode
+
+
+def _pillow_jpeg_encoder(image_data):
+    """使用 Pillow 解码图片，返回 JPEG 编码函数"""
+    img = Image.open(io.BytesIO(image_data))
+    if img.format == "JPEG":
+        # 让 libjpeg 在 DCT 域直接缩小解码，减少 IDCT 计算量与内存占用
+        img.draft("RGB", (DECODE_TARGET_EDGE, DECODE_TARGET_EDGE))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    def encode(quality, final):
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=quality, optimize=final)
+        return buffer.getvalue()
+
+    return encode
+
+
+def _jpegtran_optimize(image_data):
+    """使用 jpegtran 无损优化 JPEG，失败时返回 None"""
     try:
-        img = Image.open(io.BytesIO(image_data))
-        if img.mode != "RGB":
-            img = img.convert("RGB")
+        result = subprocess.run(
+            [JPEGTRAN, "-optimize", "-progressive", "-copy", "none"],
+            input=image_data,
+            capture_output=True,
+            timeout=30,
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning("⚠️ jpegtran 执行失败: %s", e)
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout
+
 
+def compress_image(image_data, max_size_mb=1):
+    try:
         original_size = len(image_data)
         max_size_bytes = max_size_mb * 1024 * 1024
 
         if original_size <= max_size_bytes:
             return image_data
 
-        quality = 85
-        while True:
-            buffer = io.BytesIO()
-            img.save(buffer, format="JPEG", quality=quality, optimize=True)
-            compressed_data = buffer.getvalue()
-            if (
-                len(compressed_data) <= max_size_bytes or quality <= 5
-            ):  # 降低最低质量限制
-                return compressed_data
-            quality -= 5  # 更精细的质量调节
+        pixels = _check_pixels(image_data)
 
+        # 仅略超目标的 JPEG 先尝试无损重排霍夫曼编码，达标则无需解码重新压缩
+        if (
+            JPEGTRAN is not None
+            and original_size <= max_size_bytes * JPEGTRAN_MAX_RATIO
+            # jpegtran 需在内存中保留全部 DCT 系数，按原始尺寸限制
+            and pixels <= MAX_DECODE_PIXELS
+            and image_data.startswith(JPEG_MAGIC)
+        ):
+            optimized = _jpegtran_optimize(image_data)
+            if optimized and len(optimized) <= max_size_bytes:
+                return optimized
+
+        if pyvips is not None:
+            encode = _vips_jpeg_encoder(image_data)
+        else:
+            encode = _pillow_jpeg_encoder(image_data)
+
+        return _search_jpeg_quality(encode, max_size_bytes, original_size)
+
+    except Image.DecompressionBombError:
+        # 超大分辨率图片不能原样发出，交由调用方拒绝请求
+        raise
     except Exception as e:
         logger.exception("图片压缩失败: %s", e)
         return image_data
@@ -147,106 +553,151 @@ def parse_prompt_response(response_text):
     """解析AI返回的结构化提示词"""
     try:
         # 尝试解析JSON格式
-        data = json.loads(response_text)
+        data = orjson.loads(response_text)
         return data
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logger.warning("无法解析为JSON,返回原始文本")
         return {"raw_response": response_text}
 
 
+def write_detail_file(detail_path, detail_content):
+    """写入提示词详情文件，在后台 IO 线程中执行"""
+    try:
+        data = orjson.dumps(
+            detail_content, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        )
+        # 直接用 os.write 写出整块字节，不经过 Python 文件对象的缓冲层
+        fd = os.open(detail_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+        logger.info(f"✅ 成功保存提示词详情到 {detail_path}")
+    except Exception as e:
+        logger.warning("⚠️ 保存提示词详情失败: %s", e)
+
+
+_get_modality_count = itemgetter("modality", "tokenCount")
+
+
+def _token_details_to_dict(details, _lower=str.lower):
+    return {_lower(m): c for m, c in map(_get_modality_count, details)}
+
+
 def extract_token_usage(usage_metadata):
     """解析 Gemini usageMetadata"""
+    get = usage_metadata.get
+    return {
+        "prompt_tokens": get("promptTokenCount", 0),
+        "completion_tokens": get("candidatesTokenCount", 0),
+        "total_tokens": get("totalTokenCount", 0),
+        "prompt_detail": _token_details_to_dict(get("promptTokensDetails", [])),
+        "completion_detail": _token_details_to_dict(get("candidatesTokensDetails", [])),
+    }
 
-    def to_dict(details):
-        return {d["modality"].lower(): d["tokenCount"] for d in details}
 
-    return {
-        "prompt_tokens": usage_metadata.get("promptTokenCount", 0),
-        "completion_tokens": usage_metadata.get("candidatesTokenCount", 0),
-        "total_tokens": usage_metadata.get("totalTokenCount", 0),
-        "prompt_detail": to_dict(usage_metadata.get("promptTokensDetails", [])),
-        "completion_detail": to_dict(usage_metadata.get("candidatesTokensDetails", [])),
+# Gemini 响应体大小上限，防止异常响应占满内存
+GEMINI_MAX_RESPONSE_BYTES = 4 * 1024 * 1024
+# 网关类错误的重试次数与退避基数（秒）
+GEMINI_RETRY_STATUSES = {502, 503, 504}
+GEMINI_MAX_RETRIES = 2
+GEMINI_RETRY_BACKOFF = 0.3
+
+
+def read_capped(response, limit):
+    """流式读取响应体，超过 limit 字节时抛出异常"""
+    body = bytearray()
+    for chunk in response.iter_bytes(chunk_size=64 * 1024):
+        body += chunk
+        if len(body) > limit:
+            raise ValueError(f"响应体超过 {limit} 字节上限")
+    return bytes(body)
+
+
+def post_gemini(url, request_body):
+    """发送 Gemini 请求，遇到网关类错误时退避重试，返回 (response, body)"""
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        with HTTP_CLIENT.stream("POST", url, content=request_body) as response:
+            body = read_capped(response, GEMINI_MAX_RESPONSE_BYTES)
+        if (
+            response.status_code not in GEMINI_RETRY_STATUSES
+            or attempt == GEMINI_MAX_RETRIES
+        ):
+            return response, body
+        logger.warning(
+            "⚠️ Gemini API 返回 %s，第 %d 次重试", response.status_code, attempt + 1
+        )
+        time.sleep(GEMINI_RETRY_BACKOFF * 2**attempt)
+
+
+GEMINI_USER_TEXT = "请分析这张二次元图片并生成提示词:"
+
+
+# 内联图片的用户消息预先序列化并在 data 处切开，请求时直接夹入 base64 字节
+# base64 字符无需 JSON 转义，拼接结果仍是合法 JSON
+_INLINE_TURN_HEAD, _INLINE_TURN_TAIL = orjson.dumps(
+    {
+        "role": "user",
+        "parts": [
+            {"text": GEMINI_USER_TEXT},
+            {"inline_data": {"mime_type": "image/jpeg", "data": "IMAGE"}},
+        ],
     }
+).split(b"IMAGE")
 
 
 def call_gemini_api(
     image_base64,
     api_key,
     model_version,
-    save_dir,
-    unique_filename,
+    detail_path,
     file_uuid,
     prompt_type=0,
 ):
-    """调用Gemini API生成提示词"""
+    """调用Gemini API生成提示词
+    image_base64: bytes, 直接拼接进预先序列化的请求体
+    """
     try:
-        current_prompt = load_prompt(prompt_type)
-        contents = [
-            {"role": "user", "parts": [{"text": current_prompt}]},
-            {
-                "role": "model",
-                "parts": [
-                    {"text": "我明白了,我会按照您的要求分析图片并生成结构化的提示词..."}
-                ],
-            },
-        ]
-        contents.extend(IMITATION_DIALOGS)
-        contents.append(
-            {
-                "role": "user",
-                "parts": [
-                    {"text": "请分析这张二次元图片并生成提示词:"},
-                    {
-                        "inline_data": {
-                            "mime_type": "image/jpeg",
-                            "data": image_base64,
-                        }
-                    },
-                ],
-            }
+        # 一次 join 生成完整请求体，base64 字节只复制一次
+        request_body = b"".join(
+            (
+                _PAYLOAD_PREFIX[_prompt_key(prompt_type)],
+                _INLINE_TURN_HEAD,
+                image_base64,
+                _INLINE_TURN_TAIL,
+                _PAYLOAD_SUFFIX,
+            )
         )
 
-        payload = {
-            "contents": contents,
-            "generationConfig": {"maxOutputTokens": 2048, "temperature": 0.7},
-        }
-
         url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_version}:generateContent?key={api_key}"
 
-        proxies = {
-            "http": os.environ.get("HTTP_PROXY", ""),
-            "https": os.environ.get("HTTPS_PROXY", ""),
-        }
         logger.info(f"开始请求 Gemini API ({model_version})...")
-        response = requests.post(
-            url,
-            json=payload,
-            headers={"Content-Type": "application/json"},
-            proxies=proxies,
-            timeout=60,
-        )
+        response, body = post_gemini(url, request_body)
 
         if response.status_code != 200:
+            error_text = body.decode("utf-8", errors="replace")
             logger.error(
-                "Gemini API 返回错误: %s - %s", response.status_code, response.text
+                "Gemini API 返回错误: %s - %s", response.status_code, error_text
             )
             return (
                 jsonify(
                     {
                         "success": False,
                         "error": f"Gemini API错误: {response.status_code}",
-                        "details": response.text,
+                        "details": error_text,
                     }
                 ),
                 500,
             )
 
-        response_data = response.json()
+        response_data = orjson.loads(body)
         try:
             response_text = response_data["candidates"][0]["content"]["parts"][0][
                 "text"
             ]
-        except (KeyError, IndexError) as e:
+        except (KeyError, IndexError, TypeError):
             logger.exception("解析响应失败: %s", response_data)
             return (
                 jsonify(
@@ -266,18 +717,13 @@ def call_gemini_api(
         parsed_data = parse_prompt_response(response_text)
 
         try:
-            detail_path = os.path.join(
-                save_dir, f"{os.path.splitext(unique_filename)[0]}.json"
-            )
             detail_content = {
                 "ip": get_real_ip(),
                 "prompt_data": parsed_data,
                 "token_usage": token_usage,
                 "timestamp": datetime.now().isoformat(),
             }
-            with open(detail_path, "w", encoding="utf-8") as f:
-                json.dump(detail_content, f, ensure_ascii=False, indent=2)
-            logger.info(f"✅ 成功保存提示词详情到 {detail_path}")
+            _IO_POOL.submit(write_detail_file, detail_path, detail_content)
         except Exception as e:
             logger.warning("⚠️ 保存提示词详情失败: %s", e)
 
@@ -287,7 +733,7 @@ def call_gemini_api(
                 "prompt_data": parsed_data,
                 "raw_response": response_text,
                 "uuid": file_uuid,
-                "compressed_image": image_base64,
+                "compressed_image": image_base64.decode("ascii"),
             }
         )
 
@@ -300,19 +746,14 @@ def call_doubao_api(
     image_base64,
     api_key,
     model_version,
-    save_dir,
-    unique_filename,
+    detail_path,
     file_uuid,
     prompt_type=0,
 ):
     """调用豆包API生成提示词"""
     try:
-        current_prompt = load_prompt(prompt_type)
-        client = Ark(
-            base_url="https://ark.cn-beijing.volces.com/api/v3",
-            api_key=api_key,
-        )
-        response = client.responses.create(
+        current_prompt = get_prompt(prompt_type)
+        response = _ark_client(api_key).responses.create(
             model=model_version,
             input=[
                 {
@@ -334,26 +775,21 @@ def call_doubao_api(
         logger.info(f"豆包API响应: {response}")
 
         # 提取响应文本
-        if (
-            response.output
-            and len(response.output) > 0
-            and response.output[0].content
-            and len(response.output[0].content) > 0
-        ):
-
+        try:
             response_text = response.output[0].content[0].text
-            logger.info(f"提取的响应文本: {response_text}")
-            try:
-                prompt_data = json.loads(response_text)
-                logger.info("✅ 成功解析豆包API返回的JSON数据")
-            except json.JSONDecodeError as e:
-                logger.error(f"❌ JSON解析失败: {e}")
-                # 如果解析失败，返回原始文本
-                prompt_data = {"raw_response": response_text}
-        else:
+        except (IndexError, AttributeError, TypeError):
             logger.error("❌ 响应结构异常，无法提取文本内容")
             return jsonify({"success": False, "error": "API响应结构异常"}), 500
 
+        logger.info(f"提取的响应文本: {response_text}")
+        try:
+            prompt_data = orjson.loads(response_text)
+            logger.info("✅ 成功解析豆包API返回的JSON数据")
+        except orjson.JSONDecodeError as e:
+            logger.error(f"❌ JSON解析失败: {e}")
+            # 如果解析失败，返回原始文本
+            prompt_data = {"raw_response": response_text}
+
         # 提取token使用信息
         token_usage = {
             "prompt_tokens": response.usage.input_tokens if response.usage else 0,
@@ -365,9 +801,6 @@ def call_doubao_api(
 
         # 保存详细结果到文件
         try:
-            detail_path = os.path.join(
-                save_dir, f"{os.path.splitext(unique_filename)[0]}.json"
-            )
             detail_content = {
                 "ip": get_real_ip(),
                 "prompt_data": prompt_data,
@@ -377,9 +810,7 @@ def call_doubao_api(
                 "status": response.status,
                 "timestamp": datetime.now().isoformat(),
             }
-            with open(detail_path, "w", encoding="utf-8") as f:
-                json.dump(detail_content, f, ensure_ascii=False, indent=2)
-            logger.info(f"✅ 成功保存提示词详情到 {detail_path}")
+            _IO_POOL.submit(write_detail_file, detail_path, detail_content)
         except Exception as e:
             logger.warning("⚠️ 保存提示词详情失败: %s", e)
 
@@ -402,9 +833,25 @@ def call_doubao_api(
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+# 首页渲染结果缓存: (页面字节, ETag)
+_INDEX_PAGE = None
+
+
 @app.route("/")
 def index():
-    return render_template("index.html")
+    """首页内容固定，只渲染一次并带 ETag 缓存，调试模式下每次重新渲染"""
+    global _INDEX_PAGE
+    if _INDEX_PAGE is None or app.debug:
+        # 模板中使用了 url_for，需在请求上下文中渲染
+        page = render_template("index.html").encode()
+        _INDEX_PAGE = (page, hashlib.md5(page).hexdigest())
+    page, etag = _INDEX_PAGE
+    response = app.response_class(page, mimetype="text/html")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    # 请求携带匹配的 If-None-Match 时返回 304
+    return response.make_conditional(request)
 
 
 @app.route("/encrypt_api_key", methods=["POST"])
@@ -427,6 +874,9 @@ def encrypt_api_key_route():
 @app.route("/generate_prompt", methods=["POST"])
 def generate_prompt():
     try:
+        if request.content_length and request.content_length > MAX_REQUEST_SIZE:
+            return jsonify({"success": False, "error": "文件过大"}), 413
+
         if "image" not in request.files:
             return jsonify({"success": False, "error": "没有上传图片"}), 400
 
@@ -458,15 +908,6 @@ def generate_prompt():
                 400,
             )
 
-        image_data = file.read()
-
-        max_file_size = 10 * 1024 * 1024
-        if len(image_data) > max_file_size:
-            return (
-                jsonify({"success": False, "error": "图片文件大小不能超过 10MB"}),
-                400,
-            )
-
         # 获取API配置参数
         api_model = request.form.get("api_model", "gemini")
         model_version = request.form.get("model_version", "gemini-2.5-flash-lite")
@@ -480,31 +921,51 @@ def generate_prompt():
             logger.error(f"API Key解密失败: {e}")
             return jsonify({"success": False, "error": "API Key解密失败"}), 400
 
-        today_str = datetime.now().strftime("%Y-%m-%d")
-        save_dir = os.path.join(UPLOAD_BASE_DIR, today_str)
-        os.makedirs(save_dir, exist_ok=True)
-        file_uuid = uuid.uuid4().hex
+        save_dir = today_upload_dir()
+        file_uuid = secrets.token_hex(16)
         ext = os.path.splitext(file.filename)[-1] or ".jpg"
-        unique_filename = f"{file_uuid}{ext}"
-        save_path = os.path.join(save_dir, unique_filename)
+        save_path = os.path.join(save_dir, file_uuid + ext)
+        detail_path = os.path.join(save_dir, file_uuid + ".json")
 
-        # 保存原图
-        with open(save_path, "wb") as f:
-            f.write(image_data)
+        # 保存原图（分块写入磁盘，不在内存中整体读入后再写出）
+        save_upload(file, save_path)
+
+        image_size = os.path.getsize(save_path)
+        max_file_size = 10 * 1024 * 1024
+        if image_size > max_file_size:
+            os.remove(save_path)
+            return (
+                jsonify({"success": False, "error": "图片文件大小不能超过 10MB"}),
+                400,
+            )
+        if image_size == 0:
+            os.remove(save_path)
+            return jsonify({"success": False, "error": "图片文件为空"}), 400
 
-        compressed_image_data = image_data
         max_compressed_size = 500 * 1024
-        if len(image_data) > max_compressed_size:
+        if image_size > max_compressed_size:
+            with open(save_path, "rb") as f:
+                image_data = f.read()
             logger.info("图片超过500KB,开始压缩...")
-            compressed_image_data = compress_image(image_data, max_size_mb=0.5)
+            try:
+                compressed_image_data = compress_image(image_data, max_size_mb=0.5)
+            except Image.DecompressionBombError as e:
+                logger.warning("⚠️ 拒绝超大分辨率图片: %s", e)
+                os.remove(save_path)
+                return jsonify({"success": False, "error": "图片分辨率过大"}), 400
             if len(compressed_image_data) > max_compressed_size:
 
                 compressed_image_data = compress_image(
                     compressed_image_data, max_size_mb=0.4
                 )
             logger.info(f"压缩后图片大小: {len(compressed_image_data) / 1024:.2f}KB")
-
-        image_base64 = base64.b64encode(compressed_image_data).decode("utf-8")
+            image_base64 = _b64encode(compressed_image_data)
+        else:
+            # 无需压缩时直接映射已保存的文件做 base64 编码，不再读入一份副本
+            with open(save_path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mapped:
+                image_base64 = _b64encode(mapped)
 
         # 根据选择的模型调用相应的API
         if api_model == "gemini":
@@ -512,35 +973,77 @@ def generate_prompt():
                 image_base64,
                 api_key,
                 model_version,
-                save_dir,
-                unique_filename,
+                detail_path,
                 file_uuid,
                 prompt_type,
             )
         elif api_model == "doubao":
             return call_doubao_api(
-                image_base64,
+                image_base64.decode("ascii"),
                 api_key,
                 model_version,
-                save_dir,
-                unique_filename,
+                detail_path,
                 file_uuid,
                 prompt_type,
             )
         else:
             return jsonify({"success": False, "error": "不支持的AI模型"}), 400
 
+    except RequestEntityTooLarge:
+        return jsonify({"success": False, "error": "文件过大"}), 413
     except Exception as e:
         logger.exception("处理图片失败: %s", e)
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def save_upload(file, save_path):
+    """保存上传文件，已落盘的临时文件直接在内核中拷贝"""
+    stream = file.stream
+    # SpooledTemporaryFile 仅在 _rolled 为真时才有真实文件，
+    # 内存中的上传调用 fileno() 反而会触发落盘，交给 file.save 处理
+    if not hasattr(os, "copy_file_range") or not getattr(stream, "_rolled", False):
+        file.save(save_path)
+        return
+
+    src_fd = stream.fileno()
+    size = os.fstat(src_fd).st_size
+    dst_fd = os.open(save_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        offset = 0
+        while offset < size:
+            copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except OSError as e:
+        # 文件系统不支持时退回普通拷贝
+        logger.warning("⚠️ copy_file_range 失败，改用普通拷贝: %s", e)
+    finally:
+        os.close(dst_fd)
+    file.save(save_path)
+
+
 def get_real_ip():
-    if "X-Forwarded-For" in request.headers:
-        ip_list = request.headers["X-Forwarded-For"].split(",")
-        return ip_list[0].strip()
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for:
+        first_ip, _, _ = forwarded_for.partition(",")
+        return first_ip.strip()
     return request.remote_addr
 
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    parser = argparse.ArgumentParser(description="Promptoon 提示词生成服务")
+    parser.add_argument(
+        "--dev", action="store_true", help="使用 Flask 开发服务器并开启调试模式"
+    )
+    args = parser.parse_args()
+
+    port = int(os.environ.get("PORT", "5000"))
+    if args.dev:
+        app.run(debug=True, host="0.0.0.0", port=port)
+    else:
+        logger.warning(
+            "⚠️ 生产环境请使用 gunicorn 启动: gunicorn -c gunicorn.conf.py promptoon:app"
+        )
+        app.run(host="0.0.0.0", port=port, threaded=True)